@@ -1,76 +1,235 @@
 import os
+import gc
+import asyncio
+import hashlib
+import io
 import tempfile
+import threading
+from collections import OrderedDict, deque
 import streamlit as st
-from langchain_openai import ChatOpenAI
-from openai import OpenAI
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, Docx2txtLoader
-
-# 初始化ChatOpenAI模型
-model = ChatOpenAI(
-    base_url='https://api.deepseek.com/',
-    model='deepseek-reasoner',
-    temperature=0,
-    api_key=st.secrets["OPENAI_API_KEY"]  
-)
-
-def get_answer(question: str, strict_file_mode: bool = False):
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+@st.cache_resource(show_spinner=False)
+def get_api_key():
+    # 密钥只读取一次（脚本每次重新运行都会重新定义函数，所以用st.cache_resource而不是lru_cache）
+    # 优先使用st.secrets，没有则读取.env/环境变量；未配置时抛出异常，异常不会被缓存，配置密钥后无需重启
     try:
-        client = OpenAI(
-            base_url='https://api.deepseek.com',
-            api_key=st.secrets["OPENAI_API_KEY"]  # 修改为使用st.secrets
-        )
+        api_key = st.secrets["OPENAI_API_KEY"]
+    except (KeyError, FileNotFoundError):
+        load_dotenv()
+        api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("未配置OPENAI_API_KEY")
+    return api_key
+
+
+# 发送给接口的最大历史消息条数
+MAX_HISTORY = 20
+
+# 发送给接口的历史消息token预算（不含文件内容）
+HISTORY_TOKEN_BUDGET = 6000
+
+# 严格文件模式的系统提示词，上传文件时拼接一次
+FILE_PROMPT_PREFIX = "请严格根据以下文件内容回答问题，如果文件内容中没有相关信息，请回答'根据文件内容无法回答该问题':\n\n文件内容:\n"
+
+# 进程内最多保留的已解析文件数
+MAX_STORED_FILES = 8
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str):
+    # 缓存客户端，复用底层连接池，避免每次提问重新建立连接
+    return OpenAI(
+        base_url='https://api.deepseek.com',
+        api_key=api_key
+    )
+
+
+def get_answer(question: str, strict_file_mode: bool = False, result: dict = None):
+    # result用于告知调用方回答是否完整生成：出错时会先输出已生成的部分和错误提示
+    try:
+        client = get_openai_client(get_api_key())
 
         messages = []
-        for role, content in st.session_state['messages'][:-1]:
-            messages.append({
-                'role': 'assistant' if role == 'ai' else 'user',
-                'content': content
-            })
 
-        messages.append({'role': 'user', 'content': question})
+        # 文件内容放在开头的系统消息中，每轮保持不变，便于接口复用前缀缓存
+        file_prompt = get_file_prompt() if strict_file_mode else ""
+        if file_prompt is None:
+            yield '文件内容已失效，请重新上传文件后再提问'
+            return
+        if file_prompt:
+            messages.append({'role': 'system', 'content': file_prompt})
 
-        if strict_file_mode and st.session_state['file_content']:
-            messages[-1][
-                'content'] = f"请严格根据以下文件内容回答问题，如果文件内容中没有相关信息，请回答'根据文件内容无法回答该问题':\n\n文件内容:\n{st.session_state['file_content']}\n\n问题:{question}"
+        # 历史消息在追加时已转换好；最后一条是当前问题
+        messages.extend(trim_history(list(st.session_state['api_messages'])[:-1]))
+        messages.append({'role': 'user', 'content': question})
 
         response = client.chat.completions.create(
             model='deepseek-reasoner',
             messages=messages,
             temperature=0,
-            max_tokens=2048
+            max_tokens=2048,
+            stream=True
         )
 
-        return response.choices[0].message.content
+        # 逐块返回生成内容，边生成边显示
+        for chunk in response:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+
+        if result is not None:
+            result['complete'] = True
     except Exception as err:
         print(err)
-        return '暂时无法提供回复，请检查你的配置是否正确'
+        yield '暂时无法提供回复，请检查你的配置是否正确'
 
 
-def load_file(uploaded_file):
-    file_type = uploaded_file.name.split('.')[-1].lower()
-    content = ""
-    tmp_file_path = None
+def ask_many(message_batches):
+    # 并发发送多组对话请求（如并行重排、生成标题等），按输入顺序返回各组回答
+    # 异步客户端绑定事件循环，因此在每次asyncio.run内创建，同一批请求共用连接池
+    async def run():
+        async with AsyncOpenAI(base_url='https://api.deepseek.com', api_key=get_api_key()) as aclient:
+            async def ask(messages):
+                response = await aclient.chat.completions.create(
+                    model='deepseek-reasoner',
+                    messages=messages,
+                    temperature=0,
+                    max_tokens=2048
+                )
+                return response.choices[0].message.content
 
+            return await asyncio.gather(*(ask(messages) for messages in message_batches))
+
+    return asyncio.run(run())
+
+
+@st.cache_resource(show_spinner=False)
+def get_encoder():
+    # tiktoken首次使用需要下载编码文件；加载失败时返回None并缓存结果，不在每轮对话中重试
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_type}") as tmp_file:
-            file_content = uploaded_file.getvalue()
-            tmp_file.write(file_content if isinstance(file_content, bytes) else file_content.encode('utf-8'))
-            tmp_file_path = tmp_file.name
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as err:
+        print(err)
+        return None
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def count_tokens(text):
+    encoder = get_encoder()
+    if encoder is None:
+        # 没有编码器时按字符数估算（中文约一字一token，对英文偏保守）
+        return len(text)
+    return len(encoder.encode(text))
+
+
+def trim_history(history, budget=HISTORY_TOKEN_BUDGET):
+    # 从最新的消息往前累加token数，超出预算后丢弃更早的消息
+    kept = []
+    used = 0
+    for message in reversed(history):
+        used += count_tokens(message['content'])
+        if used > budget:
+            break
+        kept.append(message)
+    kept.reverse()
+    # deepseek-reasoner要求第一条非系统消息是用户消息，截断后以回答开头时去掉该回答
+    while kept and kept[0]['role'] != 'user':
+        del kept[0]
+    return kept
+
+
+def to_api_message(role, content):
+    return {'role': 'user' if role == 'human' else 'assistant', 'content': content}
+
+
+def reset_api_messages():
+    # 根据完整对话记录重建发送给接口的历史（只保留最近MAX_HISTORY条）
+    # 开头的问候语只用于界面显示，从第一个问题开始发送
+    messages = st.session_state['messages']
+    start = next((idx for idx, (role, _, _) in enumerate(messages) if role == 'human'), len(messages))
+    st.session_state['api_messages'] = deque(
+        (to_api_message(role, content) for role, content, _ in messages[start:]),
+        maxlen=MAX_HISTORY
+    )
+
+
+def make_message(role, content):
+    # 每条消息带一个稳定编号，侧边栏的删除按钮和锚点按编号定位，不受消息位置变化影响
+    msg_id = st.session_state.get('next_message_id', 0)
+    st.session_state['next_message_id'] = msg_id + 1
+    return role, content, msg_id
+
 
+def add_message(role, content):
+    st.session_state['messages'].append(make_message(role, content))
+    st.session_state['api_messages'].append(to_api_message(role, content))
+
+
+def discard_last_message():
+    st.session_state['messages'].pop()
+    st.session_state['api_messages'].pop()
+
+
+def delete_exchange(msg_id):
+    # 删除按钮的回调：点击时按编号查找问题，连同其后的回答一起删除
+    messages = st.session_state['messages']
+    for idx, (_, _, current_id) in enumerate(messages):
+        if current_id == msg_id:
+            end = idx + 2 if idx + 1 < len(messages) and messages[idx + 1][0] != 'human' else idx + 1
+            del messages[idx:end]
+            reset_api_messages()
+            return
+
+
+def parse_file(file_type: str, file_content: bytes):
+    tmp_file_path = None
+
+    try:
+        # 纯文本直接解码，无需写临时文件再用TextLoader读回
         if file_type == 'txt':
-            loader = TextLoader(tmp_file_path, encoding='utf-8')
-        elif file_type == 'pdf':
-            loader = PyPDFLoader(tmp_file_path)
-        elif file_type == 'docx':
-            loader = Docx2txtLoader(tmp_file_path)
-        else:
+            return file_content.decode('utf-8', errors='replace') if isinstance(file_content, bytes) else file_content
+
+        # docx直接从内存解析，无需写临时文件
+        if file_type == 'docx':
+            from docx import Document
+            from docx.table import Table
+            document = Document(io.BytesIO(file_content))
+            # 按文档顺序遍历段落和表格，表格内容保留在原来的位置，每行用制表符分隔
+            parts = []
+            for block in document.iter_inner_content():
+                if isinstance(block, Table):
+                    parts.extend("\t".join(cell.text for cell in row.cells) for row in block.rows)
+                else:
+                    parts.append(block.text)
+            return "\n\n".join(parts)
+        elif file_type != 'pdf':
             return "不支持的文件类型"
 
-        docs = loader.load()
-        for doc in docs:
-            content += doc.page_content + "\n\n"
+        # 直接用文件描述符写入，绕过Python的缓冲IO，通常一次系统调用即可写完
+        fd, tmp_file_path = tempfile.mkstemp(suffix=f".{file_type}")
+        try:
+            view = memoryview(file_content if isinstance(file_content, bytes) else file_content.encode('utf-8'))
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
 
-        return content
+        # 按需导入解析器，未上传pdf时不加载pypdfium2
+        # 使用PDFium(C++)逐页提取文本，比纯Python的pypdf快得多
+        # PDFium不是线程安全的，不能多线程并行提取；逐页处理并及时释放页面占用的内存
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(tmp_file_path)
+        try:
+            parts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                parts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+        return "\n\n".join(parts)
     except Exception as e:
         return f"文件加载失败: {str(e)}"
     finally:
@@ -79,13 +238,94 @@ def load_file(uploaded_file):
                 os.unlink(tmp_file_path)
             except:
                 pass
+        # 解析器会产生大量临时对象，解析完成后主动回收一次
+        if file_type in ('pdf', 'docx'):
+            gc.collect()
+
+
+def get_file_hash(uploaded_file):
+    # 同一次上传的file_id在重新运行时不变，复用已算好的哈希，不必每次读取整个文件
+    cached = st.session_state.get('upload_hash')
+    if cached and cached[0] == uploaded_file.file_id:
+        return cached[1]
+    file_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    st.session_state['upload_hash'] = (uploaded_file.file_id, file_hash)
+    return file_hash
+
+
+def load_file(uploaded_file):
+    # 返回(文件哈希, 提示词)；共享存储中已有该文件时直接复用，不再解析。解析失败时返回错误信息
+    file_hash = get_file_hash(uploaded_file)
+    file_prompt = get_stored_prompt(file_hash)
+    if file_prompt is None:
+        file_type = uploaded_file.name.split('.')[-1].lower()
+        file_content = parse_file(file_type, uploaded_file.getvalue())
+        if file_content.startswith("文件加载失败"):
+            return file_hash, file_content
+        file_prompt = store_file_content(file_hash, file_content)
+    return file_hash, file_prompt
+
+
+@st.cache_resource(show_spinner=False)
+def get_content_store():
+    # 所有会话共享的文件提示词存储（解析结果只缓存在这里），会话中只保存文件哈希；
+    # 同一文件只保留一份，超出上限时淘汰最久未使用的。多个会话在不同线程中访问，用锁保护
+    return OrderedDict(), threading.Lock()
 
 
+def store_file_content(file_hash, content):
+    store, lock = get_content_store()
+    # 提示词只拼接一次，之后每轮对话都复用同一个字符串
+    file_prompt = FILE_PROMPT_PREFIX + content
+    with lock:
+        store[file_hash] = file_prompt
+        while len(store) > MAX_STORED_FILES:
+            store.popitem(last=False)
+    return file_prompt
+
+
+def get_stored_prompt(file_hash):
+    store, lock = get_content_store()
+    with lock:
+        file_prompt = store.get(file_hash)
+        if file_prompt is not None:
+            store.move_to_end(file_hash)
+    return file_prompt
+
+
+def get_file_prompt():
+    # 没有上传文件时返回""；文件已被淘汰时，若上传框中仍是该文件则重新解析，否则返回None
+    file_hash = st.session_state['file_hash']
+    if not file_hash:
+        return ""
+    file_prompt = get_stored_prompt(file_hash)
+    if file_prompt is None:
+        uploaded_file = st.session_state.get('uploaded_file')
+        if uploaded_file is not None and get_file_hash(uploaded_file) == file_hash:
+            _, file_prompt = load_file(uploaded_file)
+            if file_prompt.startswith("文件加载失败"):
+                file_prompt = None
+    return file_prompt
+
+
+@st.cache_resource(show_spinner=False)
+def tune_gc():
+    # 调高第0代回收阈值，避免对话过程中频繁触发垃圾回收；每个进程只设置一次
+    gc.set_threshold(50000, 10, 10)
+    return True
+
+
+tune_gc()
+
 # 初始化会话状态
 if 'messages' not in st.session_state:
-    st.session_state['messages'] = [('🐯', '(ฅฅ´ω`ฅฅ)你好，我是你的AI助手晓生，为你解决所有问题')]
-if 'file_content' not in st.session_state:
-    st.session_state['file_content'] = ""
+    st.session_state['messages'] = [make_message('🐯', '(ฅฅ´ω`ฅฅ)你好，我是你的AI助手晓生，为你解决所有问题')]
+if 'api_messages' not in st.session_state:
+    reset_api_messages()
+if 'file_hash' not in st.session_state:
+    st.session_state['file_hash'] = None
+if 'file_preview' not in st.session_state:
+    st.session_state['file_preview'] = ""
 if 'strict_file_mode' not in st.session_state:
     st.session_state['strict_file_mode'] = False
 
@@ -100,7 +340,8 @@ with st.sidebar:
     uploaded_file = st.file_uploader(
         "📤上传文件 (txt/pdf/docx)",
         type=['txt', 'pdf', 'docx'],
-        help="上传文件后，回答将严格基于文件内容"
+        help="上传文件后，回答将严格基于文件内容",
+        key='uploaded_file'
     )
 
     # 严格模式开关
@@ -112,58 +353,76 @@ with st.sidebar:
 
     if uploaded_file:
         with st.spinner('正在解析文件内容...'):
-            file_content = load_file(uploaded_file)
-            if file_content.startswith("文件加载失败"):
-                st.error(file_content)
-                st.session_state['file_content'] = ""
+            file_hash, file_prompt = load_file(uploaded_file)
+            if file_prompt.startswith("文件加载失败"):
+                st.error(file_prompt)
+                st.session_state['file_hash'] = None
             else:
-                st.session_state['file_content'] = file_content
+                # 预览只在上传新文件时生成一次，之后直接复用
+                if st.session_state['file_hash'] != file_hash:
+                    start = len(FILE_PROMPT_PREFIX)
+                    st.session_state['file_preview'] = file_prompt[start:start + 1000] + ("..." if len(file_prompt) - start > 1000 else "")
+                st.session_state['file_hash'] = file_hash
                 st.success("✅文件解析完成！")
                 st.text_area("📝 文件内容预览",
-                             value=file_content[:1000] + ("..." if len(file_content) > 1000 else ""),
+                             value=st.session_state['file_preview'],
                              height=200)
 
     st.title('对话管理')
 
     # 清空所有对话按钮
     if st.button('🔄 清空所有对话'):
-        st.session_state['messages'] = [('🐯', '(ฅ´ω`ฅ)对话历史已清空，请问我新的问题吧')]
+        st.session_state['messages'] = [make_message('🐯', '(ฅ´ω`ฅ)对话历史已清空，请问我新的问题吧')]
+        reset_api_messages()
         st.rerun()
 
     st.divider()
     st.title('对话记录')
 
     # 显示可删除的对话历史
-    for idx, (role, content) in enumerate(reversed(st.session_state['messages'])):
+    # 对话区域单独重新运行时这里不会刷新，所以按钮和链接都按消息编号而不是位置定位
+    for role, content, msg_id in reversed(st.session_state['messages']):
         if role == 'human':
             truncated_content = content[:20] + ("..." if len(content) > 20 else "")
             col1, col2 = st.columns([4, 1])
             with col1:
-                st.markdown(f"[{truncated_content}](#{idx})", unsafe_allow_html=True)
+                st.markdown(f"[{truncated_content}](#msg-{msg_id})", unsafe_allow_html=True)
             with col2:
-                if st.button('🗑️', key=f"del_{idx}", type="secondary"):
-                    # 删除指定对话
-                    del st.session_state['messages'][len(st.session_state['messages']) - 1 - idx]
-                    del st.session_state['messages'][len(st.session_state['messages']) - 1 - idx]
-                    st.rerun()
-
-# 显示历史对话
-for idx, (role, content) in enumerate(st.session_state['messages']):
-    message_container = st.container()
-    with message_container:
+                # 删除指定对话
+                st.button('🗑️', key=f"del_{msg_id}", type="secondary",
+                          on_click=delete_exchange, args=(msg_id,))
+
+# 对话区域：发送消息时只重新运行这一部分，不会重新渲染侧边栏和解析文件
+@st.fragment
+def chat_area():
+    # 显示历史对话（Streamlit每次运行都会重新绘制页面，只能减少每条消息的元素数）
+    for role, content, msg_id in st.session_state['messages']:
         st.chat_message(role).write(content)
-        st.markdown(f'<a name="{len(st.session_state["messages"]) - idx - 1}"></a>', unsafe_allow_html=True)
-
-# 用户输入
-user_input = st.chat_input(placeholder='遇事不决，问百晓生')
-if user_input:
-    st.session_state['messages'].append(('human', user_input))
-    st.chat_message('human').write(user_input)
-
-    with st.spinner('晓生思考中，少侠莫急...'):
-        answer = get_answer(
-            user_input,
-            strict_file_mode=st.session_state['strict_file_mode']
-        )
-        st.chat_message('🐯').write(answer)
-        st.session_state['messages'].append(('🐯', answer))
+        st.markdown(f'<a name="msg-{msg_id}"></a>', unsafe_allow_html=True)
+
+    # 用户输入
+    user_input = st.chat_input(placeholder='遇事不决，问百晓生')
+    if user_input:
+        add_message('human', user_input)
+        st.chat_message('human').write(user_input)
+
+        with st.spinner('晓生思考中，少侠莫急...'):
+            result = {}
+            answered = False
+            try:
+                answer = st.chat_message('🐯').write_stream(get_answer(
+                    user_input,
+                    strict_file_mode=st.session_state['strict_file_mode'],
+                    result=result
+                ))
+                if result.get('complete'):
+                    add_message('🐯', answer)
+                    answered = True
+            finally:
+                # 回答失败、或生成中途因新的提问/点击按钮被打断时，不记入历史，
+                # 避免留下没有回答的问题或把错误提示当作助手回复发给接口
+                if not answered:
+                    discard_last_message()
+
+
+chat_area()